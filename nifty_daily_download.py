@@ -16,6 +16,8 @@ import tempfile
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 import math
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 
 # =========================================================
@@ -63,6 +65,11 @@ IST = timezone(timedelta(hours=5, minutes=30))
 WEEKS_FOR_RANGE = 6
 NIFTY_TOKEN = "99926000"
 NIFTY_STRIKE_MULTIPLE = 50
+
+# Output format for per-symbol candle files: "parquet" (default) or "csv"
+OUTPUT_FORMAT = os.getenv("FORMAT", "parquet").lower()
+FILE_EXT = "csv" if OUTPUT_FORMAT == "csv" else "parquet"
+CANDLE_COLUMNS = ["Date", "Open", "High", "Low", "Close", "Volume"]
 # =========================================================
 # THREAD SAFE GLOBALS
 # =========================================================
@@ -236,6 +243,37 @@ def get_candles_with_retry(smart, params):
     return None
 
 
+def candles_to_bytes(data):
+    """Serialize raw candle rows to Parquet (default) or CSV bytes."""
+    buf = io.BytesIO()
+
+    if OUTPUT_FORMAT == "csv":
+        df = pd.DataFrame(data, columns=CANDLE_COLUMNS)
+        df["Date"] = pd.to_datetime(df["Date"]).dt.tz_localize(None)
+        df.to_csv(buf, index=False, date_format="%Y-%m-%d %H:%M:%S")
+        return buf.getvalue()
+
+    # Parquet: build arrays straight from the candle rows, no DataFrame round-trip
+    cols = list(zip(*data))
+    dates = pd.to_datetime(cols[0])
+    if dates.tz is not None:
+        dates = dates.tz_localize(None)
+
+    table = pa.Table.from_arrays(
+        [
+            pa.array(dates),
+            pa.array(np.asarray(cols[1], dtype=np.float64)),
+            pa.array(np.asarray(cols[2], dtype=np.float64)),
+            pa.array(np.asarray(cols[3], dtype=np.float64)),
+            pa.array(np.asarray(cols[4], dtype=np.float64)),
+            pa.array(np.asarray(cols[5], dtype=np.int64)),
+        ],
+        names=CANDLE_COLUMNS,
+    )
+    pq.write_table(table, buf, compression="zstd")
+    return buf.getvalue()
+
+
 def download_symbol(args):
     smart, row, FROM, TO = args
     symbol = row["TradingSymbol"]
@@ -251,15 +289,7 @@ def download_symbol(args):
 
     r = get_candles_with_retry(smart, params)
     if r and r.get("data"):
-        df = pd.DataFrame(
-            r["data"],
-            columns=["Date","Open","High","Low","Close","Volume"]
-        )
-        df["Date"] = pd.to_datetime(df["Date"]).dt.tz_localize(None)
-        buf = io.BytesIO()
-        with pd.ExcelWriter(buf, engine="openpyxl") as w:
-            df.to_excel(w, index=False)
-        return symbol, buf.getvalue(), None
+        return symbol, candles_to_bytes(r["data"]), None
 
     return symbol, None, "No data"
 
@@ -295,7 +325,7 @@ def main():
         for symbol, data, err in ex.map(download_symbol, args):
             if data:
                 with zipfile.ZipFile(zip_buf, "a") as zf:
-                    zf.writestr(f"{symbol}.xlsx", data)
+                    zf.writestr(f"{symbol}.{FILE_EXT}", data)
                 success_list.append(symbol)
             else:
                 failed_list.append(symbol)
@@ -9,13 +9,19 @@ import zipfile
 import io
 import traceback
 import logging
+import json
+import queue
 import concurrent.futures
-from threading import Lock
+from threading import Lock, local
 import numpy as np
 import tempfile
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
-import math
+import functools
+import hashlib
+from pathlib import Path
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 
 # =========================================================
@@ -62,6 +68,28 @@ IST = timezone(timedelta(hours=5, minutes=30))
 
 WEEKS_FOR_RANGE = 6
 
+# Output format for per-symbol candle files: "parquet" (default) or "csv"
+OUTPUT_FORMAT = os.getenv("FORMAT", "parquet").lower()
+FILE_EXT = "csv" if OUTPUT_FORMAT == "csv" else "parquet"
+CANDLE_COLUMNS = ["Date", "Open", "High", "Low", "Close", "Volume"]
+
+# Parquet entries are already zstd-compressed by pyarrow, so the archive
+# just stores them; only CSV output still benefits from deflate
+ZIP_COMPRESSION = (
+    zipfile.ZIP_DEFLATED if OUTPUT_FORMAT == "csv" else zipfile.ZIP_STORED
+)
+
+# On-disk candle cache: a (token, FROM, TO) window ending on expiry day is
+# immutable once downloaded, so entries never expire. Workers serialize
+# straight into this directory and zips are streamed from it;
+# CACHE_DISABLE=1 only skips reuse of entries left by earlier runs.
+CACHE_DIR = Path(".cache/candles")
+CACHE_DISABLE = os.getenv("CACHE_DISABLE", "").lower() in ("1", "true", "yes")
+
+# Session-token cache: Angel tokens stay valid for the trading day, so
+# back-to-back runs can skip generateSession (and a fresh TOTP) entirely
+SESSION_CACHE = Path(".cache/session.json")
+
 # Symbol configuration
 SYMBOL_CONFIG = {
     "BANKNIFTY": {
@@ -84,29 +112,21 @@ SYMBOL_CONFIG = {
     }
 }
 
-# =========================================================
-# THREAD SAFE GLOBALS
-# =========================================================
-success_list = []
-failed_list = []
-failed_details = []
-zip_lock = Lock()
-counter_lock = Lock()
-processed_counter = 0
-total_symbols = 0
-
 # =========================================================
 # UTILS
 # =========================================================
 def round_down_to_multiple(price, multiple):
-    return math.floor(price / multiple) * multiple
+    return int(np.floor(price / multiple) * multiple)
 
 def round_up_to_multiple(price, multiple):
-    return math.ceil(price / multiple) * multiple
+    return int(np.ceil(price / multiple) * multiple)
 
 # =========================================================
 # HISTORICAL DATA FOR EACH SYMBOL
 # =========================================================
+# Memoized per (smart_api, token, weeks): each index's range is fetched at
+# most once per run, however often calculate_strike_range is called
+@functools.lru_cache(maxsize=32)
 def get_historical_data(smart_api, symbol_token, weeks=6):
     try:
         to_date = datetime.now(IST)
@@ -123,15 +143,14 @@ def get_historical_data(smart_api, symbol_token, weeks=6):
         resp = smart_api.getCandleData(params)
 
         if resp and resp.get("status") and resp.get("data"):
-            df = pd.DataFrame(
-                resp["data"],
-                columns=["Date", "Open", "High", "Low", "Close", "Volume"]
-            )
-            df["Date"] = pd.to_datetime(df["Date"])
+            data = resp["data"]
+            # Only the OHLC aggregates are needed; reduce over the raw rows
+            # (columns after Date are Open, High, Low, Close)
+            ohlc = np.asarray([row[1:5] for row in data], dtype=np.float64)
             return {
-                "min_low": df["Low"].min(),
-                "max_high": df["High"].max(),
-                "current_close": df["Close"].iloc[-1]
+                "min_low": float(ohlc[:, 2].min()),
+                "max_high": float(ohlc[:, 1].max()),
+                "current_close": float(data[-1][4]),
             }
 
     except Exception as e:
@@ -173,40 +192,62 @@ def calculate_strike_range(smart_api, symbol_config, buffer=None):
     return max(0, start), end
 
 
+# =========================================================
+# SHARED HTTP SESSION
+# =========================================================
+# One keep-alive session with retries for all direct HTTP calls (symbol
+# master, Telegram). Angel traffic goes through SmartConnect's own client.
+http_session = requests.Session()
+http_session.mount(
+    "https://",
+    HTTPAdapter(
+        max_retries=Retry(
+            total=5, backoff_factor=2, status_forcelist=[429, 500, 502, 503]
+        )
+    ),
+)
+
+
 # =========================================================
 # SYMBOL MASTER
 # =========================================================
 def load_symbol_master():
     url = "https://api.shoonya.com/NFO_symbols.txt.zip"
-    r = requests.get(url, timeout=60)
+    r = http_session.get(url, timeout=60)
     r.raise_for_status()
 
     with zipfile.ZipFile(io.BytesIO(r.content)) as z:
         with z.open(z.namelist()[0]) as f:
-            content = "\n".join(
-                line.rstrip(",") for line in f.read().decode().splitlines()
-            )
-            return pd.read_csv(io.StringIO(content))
+            df = pd.read_csv(f, engine="pyarrow")
+
+    # The feed terminates every line with a trailing comma, which surfaces
+    # as one junk column ("" under the pyarrow engine, "Unnamed: N" under
+    # the default parser); dropping it replaces the old per-line
+    # rstrip(",") rewrite of the whole file
+    df = df.loc[:, ~(df.columns.str.startswith("Unnamed") | (df.columns == ""))]
+
+    # Parse/coerce once here so per-index filters stay pure boolean masks
+    df["ExpiryDate"] = pd.to_datetime(
+        df["Expiry"], format="%d-%b-%Y", errors="coerce", cache=True
+    ).dt.date
+    df["StrikePrice"] = pd.to_numeric(df["StrikePrice"], errors="coerce")
+    df["Symbol"] = df["Symbol"].astype("category")
+    df["Instrument"] = df["Instrument"].astype("category")
+
+    return df
 
 
 def is_today_expiry(df, symbol):
     today = datetime.now(IST).date()
-    df = df[(df["Symbol"] == symbol) & (df["Instrument"] == "OPTIDX")].copy()
-    df["ExpiryDate"] = pd.to_datetime(df["Expiry"], format="%d-%b-%Y").dt.date
-    return (today in df["ExpiryDate"].values), today
+    mask = (df["Symbol"] == symbol) & (df["Instrument"] == "OPTIDX")
+    return (today in df.loc[mask, "ExpiryDate"].values), today
 
 
 def get_option_symbols(df, symbol, expiry_date, start, end, strike_multiple):
-    expiry = expiry_date.strftime("%d-%b-%Y").upper()
-    df = df[
+    return df[
         (df["Symbol"] == symbol) &
         (df["Instrument"] == "OPTIDX") &
-        (df["Expiry"] == expiry)
-    ].copy()
-
-    df["StrikePrice"] = pd.to_numeric(df["StrikePrice"], errors="coerce")
-
-    return df[
+        (df["ExpiryDate"] == expiry_date) &
         (df["StrikePrice"] >= start) &
         (df["StrikePrice"] <= end) &
         (df["StrikePrice"] % strike_multiple == 0)
@@ -224,12 +265,8 @@ def send_zip_to_telegram(zip_bytes, name):
         path = tmp.name
 
     try:
-        session = requests.Session()
-        retries = Retry(total=5, backoff_factor=2, status_forcelist=[429,500,502,503])
-        session.mount("https://", HTTPAdapter(max_retries=retries))
-
         with open(path, "rb") as f:
-            r = session.post(
+            r = http_session.post(
                 url,
                 data={"chat_id": TELEGRAM_CHAT_ID},
                 files={"document": (name, f)},
@@ -245,170 +282,371 @@ def send_zip_to_telegram(zip_bytes, name):
         os.remove(path)
 
 
+# =========================================================
+# REQUEST THROTTLE
+# =========================================================
+# Angel's historical API allows ~3 req/sec; pace all workers globally so
+# the shared pool doesn't trip 429s.
+REQUESTS_PER_SECOND = 3
+throttle_lock = Lock()
+_next_request_at = 0.0
+
+
+def throttle():
+    global _next_request_at
+    with throttle_lock:
+        now = time.monotonic()
+        wait = _next_request_at - now
+        _next_request_at = max(now, _next_request_at) + 1.0 / REQUESTS_PER_SECOND
+    if wait > 0:
+        time.sleep(wait)
+
+
 # =========================================================
 # CANDLE DOWNLOAD
 # =========================================================
-def get_candles_with_retry(smart, params):
-    for i in range(MAX_RETRIES):
-        try:
-            r = smart.getCandleData(params)
-            if r and r.get("status"):
-                return r
-            time.sleep((i + 1) * 5)
-        except:
-            time.sleep((i + 1) * 5)
+def get_candles(smart, params):
+    """Single candle-data attempt; retries are handled by the retry queue."""
+    try:
+        throttle()
+        r = smart.getCandleData(params)
+        if r and r.get("status"):
+            return r
+    except:
+        pass
     return None
 
 
-def download_symbol(args):
-    smart, row, FROM, TO = args
-    symbol = row["TradingSymbol"]
-    token = str(row["Token"])
-
-    params = {
-        "exchange": "NFO",
-        "symboltoken": token,
-        "interval": "ONE_MINUTE",
-        "fromdate": FROM,
-        "todate": TO,
-    }
+# Angel's historical API has no multi-symbol endpoint and caps ONE_MINUTE
+# requests at 30 days per call; wider windows are fetched in segments and
+# stitched back together
+MAX_DAYS_PER_REQUEST = 30
 
-    r = get_candles_with_retry(smart, params)
-    if r and r.get("data"):
-        df = pd.DataFrame(
-            r["data"],
-            columns=["Date","Open","High","Low","Close","Volume"]
-        )
+
+def get_candles_windowed(smart, token, FROM, TO):
+    """Fetch one token's candles across FROM..TO in broker-sized segments."""
+    start = datetime.strptime(FROM, "%Y-%m-%d %H:%M")
+    end = datetime.strptime(TO, "%Y-%m-%d %H:%M")
+
+    data = []
+    while start < end:
+        seg_end = min(start + timedelta(days=MAX_DAYS_PER_REQUEST), end)
+        params = {
+            "exchange": "NFO",
+            "symboltoken": token,
+            "interval": "ONE_MINUTE",
+            "fromdate": start.strftime("%Y-%m-%d %H:%M"),
+            "todate": seg_end.strftime("%Y-%m-%d %H:%M"),
+        }
+        r = get_candles(smart, params)
+        if r is None:
+            return None
+        data.extend(r.get("data") or [])
+        # Both range ends are inclusive; skip the boundary minute
+        start = seg_end + timedelta(minutes=1)
+    return data
+
+
+def write_candles(data, path):
+    """Serialize raw candle rows to Parquet (default) or CSV at path."""
+    if OUTPUT_FORMAT == "csv":
+        df = pd.DataFrame(data, columns=CANDLE_COLUMNS)
         df["Date"] = pd.to_datetime(df["Date"]).dt.tz_localize(None)
-        buf = io.BytesIO()
-        with pd.ExcelWriter(buf, engine="openpyxl") as w:
-            df.to_excel(w, index=False)
-        return symbol, buf.getvalue(), None
+        df.to_csv(path, index=False, date_format="%Y-%m-%d %H:%M:%S")
+        return
+
+    # Parquet: build arrays straight from the candle rows, no DataFrame round-trip
+    cols = list(zip(*data))
+    dates = pd.to_datetime(cols[0])
+    if dates.tz is not None:
+        dates = dates.tz_localize(None)
+
+    table = pa.Table.from_arrays(
+        [
+            pa.array(dates),
+            pa.array(np.asarray(cols[1], dtype=np.float64)),
+            pa.array(np.asarray(cols[2], dtype=np.float64)),
+            pa.array(np.asarray(cols[3], dtype=np.float64)),
+            pa.array(np.asarray(cols[4], dtype=np.float64)),
+            pa.array(np.asarray(cols[5], dtype=np.int64)),
+        ],
+        names=CANDLE_COLUMNS,
+    )
+    pq.write_table(table, path, compression="zstd")
+
+
+def candle_cache_path(token, FROM, TO):
+    key = hashlib.md5(f"{token}|{FROM}|{TO}".encode()).hexdigest()
+    return CACHE_DIR / f"{key}.{FILE_EXT}"
+
 
-    return symbol, None, "No data"
+def download_symbol(args):
+    smart, symbol, token, FROM, TO = args
+
+    try:
+        cache_path = candle_cache_path(token, FROM, TO)
+        if not CACHE_DISABLE and cache_path.exists():
+            return symbol, cache_path, None
+
+        data = get_candles_windowed(get_thread_smart(smart), token, FROM, TO)
+        if not data:
+            return symbol, None, "No data"
+
+        # Serialize straight into the cache file (atomically via tmp+rename);
+        # the zip entry is later streamed from disk, so no per-symbol BytesIO.
+        # CACHE_DISABLE only skips reuse of existing entries above.
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            dir=CACHE_DIR, suffix=f".tmp.{FILE_EXT}", delete=False
+        ) as tmp:
+            tmp_path = tmp.name
+        write_candles(data, tmp_path)
+        os.replace(tmp_path, cache_path)
+        return symbol, cache_path, None
+
+    except Exception as e:
+        return symbol, None, str(e)
+
+
+def run_downloads(index_tasks):
+    """Drive all downloads through a bounded producer with a LIFO retry queue.
+
+    Fresh tasks and requeued failures share one LifoQueue, so a symbol that
+    just hit the rate limit is retried ahead of untouched work (by which time
+    the throttle has drained) instead of sleeping inside a worker. Submission
+    is bounded at twice the pool size rather than flooding the executor with
+    every task up front.
+    """
+    todo = queue.LifoQueue()
+    for symbol_name, args in index_tasks.items():
+        for arg in args:
+            todo.put((symbol_name, arg, 1))
+
+    results = {symbol_name: [] for symbol_name in index_tasks}
+    pool_size = MAX_WORKERS * 3
+    max_inflight = pool_size * 2
+
+    with concurrent.futures.ThreadPoolExecutor(pool_size) as ex:
+        inflight = {}
+        while inflight or not todo.empty():
+            while len(inflight) < max_inflight and not todo.empty():
+                symbol_name, arg, attempt = todo.get()
+                future = ex.submit(download_symbol, arg)
+                inflight[future] = (symbol_name, arg, attempt)
+
+            done, _ = concurrent.futures.wait(
+                inflight, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                symbol_name, arg, attempt = inflight.pop(future)
+                symbol, data, err = future.result()
+                if data is None and attempt < MAX_RETRIES:
+                    todo.put((symbol_name, arg, attempt + 1))
+                else:
+                    results[symbol_name].append((symbol, data, err))
+
+    return results
 
 
 # =========================================================
-# PROCESS SINGLE INDEX
+# PREPARE SINGLE INDEX
 # =========================================================
-def process_index(smart, df_master, symbol_name, symbol_config):
-    """Process a single index and return zip bytes if successful"""
+def prepare_index_tasks(smart, df_master, symbol_name, symbol_config):
+    """Build the download task list for one index.
+
+    Returns (expiry, args) or None if today is not this index's expiry
+    or no symbols are available.
+    """
     logger.info(f"🔍 Processing {symbol_name}...")
-    
+
     # Check if today is expiry
     is_expiry, expiry = is_today_expiry(df_master, symbol_name)
     if not is_expiry:
         logger.info(f"📅 Not {symbol_name} expiry day. Skipping.")
         return None
-    
+
     logger.info(f"✅ Today is {symbol_name} expiry day: {expiry}")
-    
+
     # Calculate strike range
     start, end = calculate_strike_range(smart, symbol_config)
     if start is None or end is None:
         logger.error(f"❌ Could not calculate strike range for {symbol_name}")
         return None
-    
+
     logger.info(f"📊 {symbol_name} strike range: {start} to {end}")
-    
+
     # Get option symbols
     df = get_option_symbols(
-        df_master, 
-        symbol_name, 
-        expiry, 
-        start, 
-        end, 
+        df_master,
+        symbol_name,
+        expiry,
+        start,
+        end,
         symbol_config["strike_multiple"]
     )
-    
+
     if df.empty:
         logger.warning(f"⚠️ No option symbols found for {symbol_name}")
         return None
-    
+
     logger.info(f"📈 Found {len(df)} option symbols for {symbol_name}")
-    
+
     # Prepare date range
     FROM = (expiry - timedelta(days=90)).strftime("%Y-%m-%d 09:15")
     TO = expiry.strftime("%Y-%m-%d 15:30")
-    
-    # Prepare arguments for parallel download
-    args = [(smart, r, FROM, TO) for _, r in df.iterrows()]
-    
-    # Create zip buffer
-    zip_buf = io.BytesIO()
-    
-    # Track success/failure for this index
-    index_success = []
-    index_failed = []
-    
-    # Download symbols in parallel
-    with concurrent.futures.ThreadPoolExecutor(MAX_WORKERS) as ex:
-        futures = {ex.submit(download_symbol, arg): arg[0] for arg in args}
-        
-        for future in concurrent.futures.as_completed(futures):
-            symbol, data, err = future.result()
-            if data:
-                with zip_lock:
-                    with zipfile.ZipFile(zip_buf, "a") as zf:
-                        zf.writestr(f"{symbol}.xlsx", data)
-                index_success.append(symbol)
-            else:
-                index_failed.append(symbol)
-                failed_details.append((symbol, err))
-    
-    # Update global counters
-    with counter_lock:
-        success_list.extend(index_success)
-        failed_list.extend(index_failed)
-    
-    if index_success:
-        zip_buf.seek(0)
-        logger.info(f"✅ Downloaded {len(index_success)} symbols for {symbol_name}")
-        return zip_buf.read()
-    else:
-        logger.warning(f"⚠️ No data downloaded for {symbol_name}")
-        return None
+
+    # Prepare arguments for parallel download; pulling the two columns as
+    # arrays avoids materializing a Series per row the way iterrows does
+    args = [
+        (smart, symbol, str(token), FROM, TO)
+        for symbol, token in zip(
+            df["TradingSymbol"].to_numpy(), df["Token"].to_numpy()
+        )
+    ]
+
+    return expiry, args
 
 
 # =========================================================
-# MAIN
+# LOGIN
 # =========================================================
-def main():
-    # Initialize API
+def login_smart():
+    """Log in to Angel, reusing the previous session token when still valid."""
     smart = SmartConnect(api_key=ANGEL_API_KEY)
+
+    if not CACHE_DISABLE and SESSION_CACHE.exists():
+        try:
+            cached = json.loads(SESSION_CACHE.read_text())
+            if cached.get("date") == datetime.now(IST).date().isoformat():
+                smart.setAccessToken(cached["jwt"])
+                smart.setRefreshToken(cached["refresh"])
+                smart.setFeedToken(cached["feed"])
+                profile = smart.getProfile(cached["refresh"])
+                if profile and profile.get("status"):
+                    logger.info("✅ Reusing cached Angel session")
+                    return smart
+        except Exception as e:
+            logger.warning(f"⚠️ Cached session unusable, logging in fresh: {e}")
+
     totp = pyotp.TOTP(ANGEL_TOTP).now()
     login = smart.generateSession(ANGEL_CLIENT_ID, ANGEL_PIN, totp)
     if not login or not login.get("status"):
         raise RuntimeError("Login failed")
-    
+
+    data = login["data"]
+    SESSION_CACHE.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+        "w", dir=SESSION_CACHE.parent, suffix=".tmp", delete=False
+    ) as tmp:
+        json.dump(
+            {
+                "date": datetime.now(IST).date().isoformat(),
+                "jwt": data["jwtToken"],
+                "refresh": data["refreshToken"],
+                "feed": data["feedToken"],
+            },
+            tmp,
+        )
+    os.replace(tmp.name, SESSION_CACHE)
+
+    return smart
+
+
+_thread_smart = local()
+
+
+def get_thread_smart(primary):
+    """Per-thread SmartConnect clone sharing the primary session's tokens.
+
+    The SmartApi client keeps mutable request state on the instance, so each
+    worker thread gets its own clone instead of all sharing one object.
+    """
+    smart = getattr(_thread_smart, "smart", None)
+    if smart is None:
+        smart = SmartConnect(api_key=ANGEL_API_KEY)
+        smart.setAccessToken(primary.access_token)
+        smart.setRefreshToken(primary.refresh_token)
+        smart.setFeedToken(primary.feed_token)
+        _thread_smart.smart = smart
+    return smart
+
+
+# =========================================================
+# MAIN
+# =========================================================
+def main():
+    # Initialize API
+    smart = login_smart()
     logger.info("✅ Login successful")
-    
+
     # Load symbol master once
     df_master = load_symbol_master()
     logger.info("✅ Symbol master loaded")
-    
-    # Process each index
+
+    # Build one combined task list across all indices
+    index_tasks = {}
+    index_expiry = {}
     for symbol_name, symbol_config in SYMBOL_CONFIG.items():
         try:
-            zip_bytes = process_index(smart, df_master, symbol_name, symbol_config)
-            
-            if zip_bytes:
-                # Send to Telegram
-                filename = f"{symbol_name}_expiry_{datetime.now(IST).strftime('%d%m%y')}_1min.zip"
-                send_zip_to_telegram(zip_bytes, filename)
-                
-                # Also save locally for debugging
-                with open(filename, "wb") as f:
-                    f.write(zip_bytes)
-                logger.info(f"💾 Saved {filename} locally")
-            else:
-                logger.info(f"📭 No data to send for {symbol_name}")
-                
+            prepared = prepare_index_tasks(smart, df_master, symbol_name, symbol_config)
         except Exception as e:
-            logger.error(f"❌ Error processing {symbol_name}: {e}")
+            logger.error(f"❌ Error preparing {symbol_name}: {e}")
             traceback.print_exc()
             continue
-    
+        if prepared:
+            index_expiry[symbol_name], index_tasks[symbol_name] = prepared
+
+    # Download all indices through one shared pool; downloads are I/O-bound
+    # and the global throttle keeps us under the broker rate limit
+    results = run_downloads(index_tasks)
+
+    # Aggregate outcomes locally: results are gathered in the main thread,
+    # so no shared lists or locks are needed
+    success_list = []
+    failed_list = []
+    failed_details = []
+
+    # Bucket results back into one zip per index, written in a single pass
+    for symbol_name, completed in results.items():
+        entries = []
+        index_failed = []
+
+        for symbol, path, err in completed:
+            if path:
+                entries.append((symbol, path))
+            else:
+                index_failed.append(symbol)
+                failed_details.append((symbol, err))
+
+        zip_buf = io.BytesIO()
+        with zipfile.ZipFile(
+            zip_buf, "w", compression=ZIP_COMPRESSION, compresslevel=1
+        ) as zf:
+            for symbol, path in entries:
+                zf.write(path, f"{symbol}.{FILE_EXT}")
+        index_success = [symbol for symbol, _ in entries]
+
+        success_list.extend(index_success)
+        failed_list.extend(index_failed)
+
+        if not index_success:
+            logger.info(f"📭 No data to send for {symbol_name}")
+            continue
+
+        logger.info(f"✅ Downloaded {len(index_success)} symbols for {symbol_name}")
+        zip_buf.seek(0)
+        zip_bytes = zip_buf.read()
+
+        # Send to Telegram, named after the expiry the tasks were built for
+        expiry_tag = index_expiry[symbol_name].strftime("%d%m%y")
+        filename = f"{symbol_name}_expiry_{expiry_tag}_1min.zip"
+        send_zip_to_telegram(zip_bytes, filename)
+
+        # Also save locally for debugging
+        with open(filename, "wb") as f:
+            f.write(zip_bytes)
+        logger.info(f"💾 Saved {filename} locally")
+
     # Summary
     logger.info(f"✅ Script completed. Success: {len(success_list)}, Failed: {len(failed_list)}")
     
@@ -15,6 +15,8 @@ import numpy as np
 import tempfile
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 # =========================================================
 # LOGGING (reduced noise for GitHub Actions)
@@ -61,6 +63,11 @@ IST = timezone(timedelta(hours=5, minutes=30))
 WEEKS_FOR_RANGE = 6
 SENSEX_TOKEN = "99919000"
 SENSEX_STRIKE_MULTIPLE = 100
+
+# Output format for per-symbol candle files: "parquet" (default) or "csv"
+OUTPUT_FORMAT = os.getenv("FORMAT", "parquet").lower()
+FILE_EXT = "csv" if OUTPUT_FORMAT == "csv" else "parquet"
+CANDLE_COLUMNS = ["Date", "Open", "High", "Low", "Close", "Volume"]
 # =========================================================
 # THREAD SAFE GLOBALS
 # =========================================================
@@ -241,6 +248,48 @@ def get_candles_with_retry(smart, params):
             time.sleep((i + 1) * 5)
     return None
 
+def candles_to_bytes(data):
+    """Serialize raw candle rows to Parquet (default) or CSV bytes.
+
+    Returns None if no rows survive date parsing.
+    """
+    buf = io.BytesIO()
+
+    if OUTPUT_FORMAT == "csv":
+        df = pd.DataFrame(data, columns=CANDLE_COLUMNS)
+        df["Date"] = pd.to_datetime(df["Date"], errors="coerce")
+        df = df.dropna(subset=["Date"])
+        if df.empty:
+            return None
+        if df["Date"].dt.tz is not None:
+            df["Date"] = df["Date"].dt.tz_convert(None)
+        df.to_csv(buf, index=False, date_format="%Y-%m-%d %H:%M:%S")
+        return buf.getvalue()
+
+    # Parquet: build arrays straight from the candle rows, no DataFrame round-trip
+    cols = list(zip(*data))
+    dates = pd.to_datetime(cols[0], errors="coerce")
+    if dates.tz is not None:
+        dates = dates.tz_convert(None)
+    valid = dates.notna()
+    if not valid.any():
+        return None
+
+    table = pa.Table.from_arrays(
+        [
+            pa.array(dates[valid]),
+            pa.array(np.asarray(cols[1], dtype=np.float64)[valid]),
+            pa.array(np.asarray(cols[2], dtype=np.float64)[valid]),
+            pa.array(np.asarray(cols[3], dtype=np.float64)[valid]),
+            pa.array(np.asarray(cols[4], dtype=np.float64)[valid]),
+            pa.array(np.asarray(cols[5], dtype=np.int64)[valid]),
+        ],
+        names=CANDLE_COLUMNS,
+    )
+    pq.write_table(table, buf, compression="zstd")
+    return buf.getvalue()
+
+
 def download_symbol(args):
     smart, row, FROM, TO = args
     symbol = row["TradingSymbol"]
@@ -260,29 +309,11 @@ def download_symbol(args):
         if not r or not r.get("data"):
             return symbol, None, "No data"
 
-        df = pd.DataFrame(
-            r["data"],
-            columns=["Date", "Open", "High", "Low", "Close", "Volume"]
-        )
-
-        # Safe datetime parsing
-        df["Date"] = pd.to_datetime(df["Date"], errors="coerce")
-
-        # Drop bad rows
-        df = df.dropna(subset=["Date"])
-
-        # Normalize timezone if present
-        if df["Date"].dt.tz is not None:
-            df["Date"] = df["Date"].dt.tz_convert(None)
-
-        if df.empty:
+        data = candles_to_bytes(r["data"])
+        if data is None:
             return symbol, None, "Empty dataframe after parsing"
 
-        buf = io.BytesIO()
-        with pd.ExcelWriter(buf, engine="openpyxl") as w:
-            df.to_excel(w, index=False, sheet_name=symbol[:31])
-
-        return symbol, buf.getvalue(), None
+        return symbol, data, None
 
     except Exception as e:
         return symbol, None, str(e)
@@ -319,7 +350,7 @@ def main():
         for symbol, data, err in ex.map(download_symbol, args):
             if data:
                 with zipfile.ZipFile(zip_buf, "a") as zf:
-                    zf.writestr(f"{symbol}.xlsx", data)
+                    zf.writestr(f"{symbol}.{FILE_EXT}", data)
                 success_list.append(symbol)
             else:
                 failed_list.append(symbol)